@@ -31,6 +31,14 @@ option_defaults = {
     "nick_buffer_unfocused": 6,
     "chan_buffer_focused": 3,
     "chan_buffer_unfocused": 10,
+    # Hold output for unfocused groups until focused
+    "render_on_focus": False,
+    # Maximum held lines, oldest are dropped first
+    "pending_limit": 500,
+    # Note how many lines were dropped per channel
+    "pending_summary": True,
+    # Lines printed per flush tick when focused
+    "pending_chunk": 50,
 }
 
 
@@ -49,6 +57,7 @@ from collections import deque, defaultdict
 from functools import partial  # Magic
 import os
 import json
+import hashlib
 from pprint import pprint
 
 MOD_SHIFT = 1
@@ -61,6 +70,16 @@ LEFT_TAB = 0xFE20
 ENTER = 0xFF0D
 BACKSPACE = 0xFF08
 
+# Tab activity colors
+TAB_MESSAGE = 2
+TAB_HILIGHT = 3
+
+# Milliseconds between pending output flushes
+FLUSH_INTERVAL = 20
+
+# Milliseconds between pevents.conf change checks
+EVENTS_POLL_INTERVAL = 5000
+
 # Standardize file location
 configdir = xchat.get_info("configdir")
 if not configdir:  # For xchat
@@ -150,10 +169,37 @@ def json_file_read(path, name):
 configdir_script = os.path.join(configdir, "addons", "config")
 
 
-registered_channels = {}
 registered_groups = {}
 
 
+# Shared per-channel state, one per (network, channel) for all groups
+class channel_state:
+    __slots__ = ("network", "channel", "groups", "styles", "last_seen", "nicks")
+
+    def __init__(self, network, channel):
+        self.network = network
+        self.channel = channel
+        self.groups = []
+        self.styles = {}  # (colored, colors, prefix) -> (visible, hidden)
+        self.last_seen = 0
+        self.nicks = {}
+
+    # Channel text for a group's style, built once per style
+    def text(self, style):
+        if style not in self.styles:
+            colored, colors, prefix = style
+            if colored:
+                color = xchat_color_string(self.channel, colors)
+            else:
+                color = colors[0]
+            self.styles[style] = (pattern_channel_visible.format(self.channel, color),
+                                  pattern_channel_hidden.format(self.channel, color, prefix))
+        return self.styles[style]
+
+
+channel_states = {}  # (network, channel) -> channel_state
+
+
 def cmd(stuff):
     xchat.command(stuff)
 
@@ -187,22 +233,28 @@ def unregister_group(group):
 
 # Channel registration
 def register_group_channel(network, channel, group, save=True):
-    l = registered_channels.setdefault(network, {}).setdefault(channel, [])
-    if group not in l:
-        l.append(group)
+    key = (network, channel)
+    state = channel_states.get(key)
+    if not state:
+        state = channel_states[key] = channel_state(network, channel)
+    if group not in state.groups:
+        state.groups.append(group)
     if save:
         group_settings_save()
 
 
 def unregister_group_channel(network, channel, group):
-    registered_channels[network][channel].remove(group)
+    state = channel_states[(network, channel)]
+    state.groups.remove(group)
+    if not state.groups:
+        del channel_states[(network, channel)]
     group_settings_save()
 
 
 # Find groups registered for given channel
 def registered_channel_groups(network, channel):
-    if network in registered_channels and channel in registered_channels[network]:
-        return iter(registered_channels[network][channel])
+    state = channel_states.get((network, channel))
+    return iter(state.groups if state else [])
 
 
 # Save group settings to file
@@ -237,11 +289,15 @@ class channel_group:
         self.auto_list = deque()
         self.auto_type = None
         self.auto_first = False
-        self.recent_users = {}
-        self.recent_channels = {}
-        self.chanrefs = {}
-        self.backrefs = {}
+        self.chanrefs = {}  # Reference key -> channel_state
+        self.backrefs = {}  # channel_state -> reference key
         self.last_action = time()
+        self.focused = xchat.find_context() == self.buffer.context
+        self.pending = deque()
+        self.pending_color = 0
+        self.pending_dropped = {}
+        self.flush_hook = None
+        self.flush_inline = False
 
         # Apply saved options
         if "options" in save_data:
@@ -252,6 +308,8 @@ class channel_group:
         for k, v in option_defaults.items():
             if k not in self.options:
                 self.options[k] = v
+        self.style_update()
+        self.pending_resize()
 
         # Load channel list
         self.channels = {}
@@ -271,32 +329,26 @@ class channel_group:
         # Focus
         if self.options["focus_on_load"]:
             self.buffer.focus()
+            self.focused = True
 
     # Simple joined output
     def _print(self, *args):
         self.buffer.context.prnt(', '.join(str(x) for x in args))
 
-    # Add recieved channel messages to buffer
-    def on_chat_message(self, network, channel, event, nick, nick_color, args, word, word_eol):
-        # Colorize channel name
-        if self.options["colored_channel_names"]:
-            channel_color = xchat_color_string(channel, self.options["channel_colors"])
-        else:
-            channel_color = self.options["channel_colors"][0]
+    # Cache channel text style from options
+    def style_update(self):
+        self.style = (self.options["colored_channel_names"],
+                      tuple(self.options["channel_colors"]),
+                      self.options["inline_channel_prefix"])
 
+    # Add recieved channel messages to buffer
+    def on_chat_message(self, state, event, nick, nick_color, args, word, word_eol, now):
         # Inline successive channels
-        if self.options["hide_inline_channel"] and self.channel_current == (network, channel):
-            channel_text = pattern_channel_hidden.format(channel, channel_color, self.options["inline_channel_prefix"])
-        else:
-            channel_text = pattern_channel_visible.format(channel, channel_color)
+        inline = self.options["hide_inline_channel"] and self.channel_current is state
 
         # Add to buffer
-        self.buffer.context.prnt(events_decoded[event].format(channel_text, word[0], *args))
-
-        # Recents
-        chanref = self.backrefs[(network, channel)]
-        self.recent_channels[chanref] = now = time()
-        self.recent_users.setdefault((network, channel), {})[nick] = now
+        self.output(state, event, word, args, inline)
+        chanref = self.backrefs.get(state, state.channel)
 
         # Update prompt
         if self.options["auto_target"]:
@@ -312,28 +364,92 @@ class channel_group:
 
         # Update state
         self.channel_previous = self.channel_current
-        self.channel_current = (network, channel)
+        self.channel_current = state
+
+    # Format a chat line with full or inline channel name
+    def render(self, state, event, word, args, inline):
+        visible, hidden = state.text(self.style)
+        return events_decoded[event].format(hidden if inline else visible, word[0], *args)
+
+    # Print line, or hold it while unfocused
+    def output(self, state, event, word, args, inline):
+        if not self.pending and (self.focused or not self.options["render_on_focus"]):
+            self.buffer.context.prnt(self.render(state, event, word, args, inline))
+            return
+        # Drop oldest
+        if len(self.pending) == self.pending.maxlen:
+            self.drop_pending()
+        self.pending.append((state, event, word, args, inline))
+        # Keep tab activity indicator current
+        if not self.focused:
+            color = TAB_HILIGHT if "Hilight" in event else TAB_MESSAGE
+            if color > self.pending_color:
+                self.pending_color = color
+                self.buffer.context.command("gui color {}".format(color))
+
+    # Track focus and start flushing held output
+    def set_focused(self, focused):
+        self.focused = focused
+        if focused:
+            self.pending_color = 0
+            self.flush_start()
+
+    # Drop oldest held line, counting it for the summary
+    def drop_pending(self):
+        state = self.pending.popleft()[0]
+        self.pending_dropped[state] = self.pending_dropped.get(state, 0) + 1
+
+    # Apply pending_limit to held output
+    def pending_resize(self):
+        limit = max(1, self.options["pending_limit"])
+        while len(self.pending) > limit:
+            self.drop_pending()
+        self.pending = deque(self.pending, maxlen=limit)
+
+    def flush_start(self):
+        if self.pending and not self.flush_hook:
+            self.flush_inline = False
+            self.flush_hook = xchat.hook_timer(FLUSH_INTERVAL, self.flush_pending)
+
+    # Print a chunk of held output, repeating until empty or unfocused
+    def flush_pending(self, userdata=None):
+        if not self.focused and self.options["render_on_focus"]:
+            self.flush_hook = None
+            return 0
+        if self.pending_dropped:
+            if self.options["pending_summary"]:
+                self._print("{} older lines not shown ({})".format(
+                    sum(self.pending_dropped.values()),
+                    ", ".join("{} {}".format(n, self.backrefs.get(s, s.channel)) for s, n in self.pending_dropped.items())))
+            self.pending_dropped.clear()
+            self.flush_inline = False
+        for i in range(min(max(1, self.options["pending_chunk"]), len(self.pending))):
+            state, event, word, args, inline = self.pending.popleft()
+            # Name the channel on the first line of each run
+            self.buffer.context.prnt(self.render(state, event, word, args, inline and self.flush_inline))
+            self.flush_inline = True
+        if self.pending:
+            return 1
+        self.flush_hook = None
+        return 0
 
     def auto_list_channels(self, search=""):
         self.auto_list.clear()
         self.auto_type = 1
         # Rest of channels
-        chans = [k for k in self.recent_channels if k.startswith(search)]
-        chans.sort(key=lambda k: self.recent_channels[k], reverse=True)
+        chans = [k for k in self.chanrefs if k.startswith(search)]
+        chans.sort(key=lambda k: self.chanrefs[k].last_seen, reverse=True)
         self.auto_list.extend(chans)
 
-    def auto_list_users(self, network, channel, search=""):
+    def auto_list_users(self, state, search=""):
         self.auto_list.clear()
         self.auto_type = 2
         p = re.compile(re.escape(search), re.I)
         # Recently seen nicks from this channel
-        if (network, channel) in self.recent_users:
-            recent = [k for k in self.recent_users[(network, channel)] if bool(p.match(k))]
-            recent.sort(reverse=True, key=lambda k: self.recent_users[(network, channel)][k])
-        else:
-            recent = []
+        recent = [k for k in state.nicks if bool(p.match(k))]
+        recent.sort(reverse=True, key=lambda k: state.nicks[k])
         # Get rest of nicks from target channel
-        channel_context = xchat.find_context(network, channel)
+        channel_context = xchat.find_context(state.network, state.channel)
         if channel_context:
             channel_context.get_info("channel")  # Without a get_info call, get_list fails
             full = [x.nick for x in channel_context.get_list("users") if bool(p.match(x.nick)) and x.nick not in recent]
@@ -381,7 +497,7 @@ class channel_group:
                         self.auto_list_channels(word[0])
                 # Search nick
                 elif num == 2 and word[0] in self.chanrefs:
-                    self.auto_list_users(self.chanrefs[word[0]][0], self.chanrefs[word[0]][1], nick)
+                    self.auto_list_users(self.chanrefs[word[0]], nick)
 
             if self.auto_list:
                 # Rotate to next
@@ -414,7 +530,7 @@ class channel_group:
         if not word or not word[0].startswith("#"):
             if self.channel_current:
                 # Add missing channel prefix
-                line = self.channel_current[1] + " " + word_eol[0]
+                line = self.channel_current.channel + " " + word_eol[0]
                 self.buffer.set_input(line)
         elif len(word) > 1:
             context = xchat.find_context(channel=word[0])
@@ -437,12 +553,29 @@ class channel_group:
 
     # Set option from string
     def set_option(self, key, value):
-        if not self.options[key]:
+        if key not in self.options:
             self._print("Could not set option", "{0} is not a valid option".format(key))
-        for t in [bool, str, list]:
-            if isinstance(self.options[key], t):
-                self.options[key] = t(value)
+            return
+        if isinstance(self.options[key], bool):
+            if value.strip().lower() not in ("true", "false"):
+                self._print("Could not set option", "{0} must be true or false".format(key))
+                return
+            self.options[key] = value.strip().lower() == "true"
+        elif isinstance(self.options[key], int):
+            try:
+                self.options[key] = int(value)
+            except ValueError:
+                self._print("Could not set option", "{0} must be a number".format(key))
+                return
+        else:
+            for t in [str, list]:
+                if isinstance(self.options[key], t):
+                    self.options[key] = t(value)
         self._print("{0} set to {1}".format(key, self.options[key]))
+        self.style_update()
+        self.pending_resize()
+        if not self.options["render_on_focus"]:
+            self.flush_start()
         self.menu_update()
 
     # def has_channel(self, channel, network=False)
@@ -494,7 +627,6 @@ class channel_group:
     def channels_update(self):
         self.chanrefs.clear()
         self.backrefs.clear()
-        self.recent_channels.clear()
         self.auto_clear()
         for network in self.channels:
             for channel in self.channels[network]:
@@ -503,15 +635,17 @@ class channel_group:
                         key = channel
                     else:
                         suffix = network[0]
-                        while self.chanrefs[channel][0].startswith(suffix):
+                        while self.chanrefs[channel].network.startswith(suffix):
                             suffix += network[len(suffix)]
                         key = channel+":"+suffix
-                    self.chanrefs[key] = (network, channel)
-                    self.backrefs[(network, channel)] = key
+                    state = channel_states[(network, channel)]
+                    self.chanrefs[key] = state
+                    self.backrefs[state] = key
         # Cheating
-        tmp = sorted(self.chanrefs.keys(), reverse=True)
-        for k in tmp:
-            self.recent_channels[k] = time() - (50 - len(self.recent_channels))
+        now = time()
+        for i, k in enumerate(sorted(self.chanrefs.keys(), reverse=True)):
+            if not self.chanrefs[k].last_seen:
+                self.chanrefs[k].last_seen = now - (50 - i)
 
     # Rename group
     def rename(self, name):
@@ -527,6 +661,8 @@ class channel_group:
     def remove(self):
         self.menu_clear()
         unregister_group(self)
+        if self.flush_hook:
+            xchat.unhook(self.flush_hook)
         self.buffer.close()
 
 
@@ -549,10 +685,11 @@ escapes = {
 }
 
 
+re_escapes = re.compile("|".join(re.escape(k) for k in escapes))
+
+
 def decode(text):
-    for k, v in escapes.items():
-        text = text.replace(k, v)
-    return text
+    return re_escapes.sub(lambda m: escapes[m.group(0)], text)
 
 # Find desired event strings
 chat_events = [
@@ -567,30 +704,101 @@ chat_events = [
 ]
 
 
-def compile_strings():
-    global events_decoded
-    # Decode strings from Text Event settings
-    re_move = re.compile(r"(.+)(%C\d*)(\$t)(.*)")  # Message color code needs to be put after tab char
-    next = ""
-    stringfile = os.path.join(configdir, "pevents.conf")
-    assert os.path.exists(stringfile), "Configuration file pevents.conf not found. You may need to use a (any) custom theme for this file to be created"
+# Built-in event strings, used when pevents.conf is missing or lacks an event
+default_events = {
+    "Channel Message": "%C18%H<%H$4$1%H>%H%O$t$2",
+    "Channel Msg Hilight": "%C19%H<%H$4$1%H>%H%O$t%C19$2",
+    "Channel Action": "%C18*$t$4$1%O $2",
+    "Channel Action Hilight": "%C19*$t$4$1%O %C19$2",
+    "Your Message": "%C31%H<%H$4$1%H>%H%O$t%C30$2",
+    "Your Action": "%C18*$t$1%O %C30$2",
+    "Private Message": "%C28*%C18$1%C28*$t%O$2",
+    "Private Action": "%C18**$t$3$1%O $2 %C18**"
+}
+
+stringfile = os.path.join(configdir, "pevents.conf")
+events_cache_key = None  # Source of the current events_decoded
+
+# Message color code needs to be put after tab char
+re_move = re.compile(r"(.+)(%C\d*)(\$t)(.*)")
+
+
+# Identifies the decoding rules, so cached events from other versions are ignored
+events_rules_hash = hashlib.md5(json.dumps(
+    [__module_version__, escapes, re_move.pattern, default_events, chat_events],
+    sort_keys=True).encode("utf-8")).hexdigest()
+
 
+# Decode an event string and add channel slot to pattern
+def decode_event(value, indent):
+    decoded = decode(re_move.sub(r"\1\3\2\4", value))
+    if indent:
+        return decoded.replace("\t", "\t{0}")
+    return "{0}" + decoded
+
+
+# Identify pevents.conf contents and the prefs that affect decoding
+def events_source_key():
+    indent = bool(xchat.get_prefs("text_indent"))
+    try:
+        st = os.stat(stringfile)
+        return [st.st_mtime, st.st_size, indent, events_rules_hash]
+    except OSError:
+        return [None, None, indent, events_rules_hash]
+
+
+# Read event strings from pevents.conf
+def read_strings():
+    strings = {}
+    next = ""
     with open(stringfile) as f:
         for line in f:
             words = line.split("=", 1)
-            if words and words[0] != "\n":
+            if len(words) == 2:
                 (key, value) = words
                 value = value.strip()
                 if key == "event_name" and value in chat_events:
                     next = value
                 elif key == "event_text" and next:
-                    # Add channel slot to pattern
-                    decoded = decode(re_move.sub(r"\1\3\2\4", value))
-                    if xchat.get_prefs("text_indent"):
-                        events_decoded[next] = decoded.replace("\t", "\t{0}")
-                    else:
-                        events_decoded[next] = "{0}" + decoded
+                    strings[next] = value
                     next = ""
+    return strings
+
+
+# Decode strings from Text Event settings, if changed since last compile
+def compile_strings():
+    global events_decoded, events_cache_key
+    key = events_source_key()
+    if key == events_cache_key:
+        return False
+
+    cached = json_file_read(configdir_script, "overwatch-events.json")
+    if (isinstance(cached, dict) and cached.get("key") == key and isinstance(cached.get("events"), dict)
+            and all(event in cached["events"] for event in chat_events)):
+        decoded = cached["events"]
+    else:
+        strings = dict(default_events)
+        if key[0] is not None:
+            strings.update(read_strings())
+        else:
+            print(__module_name__, "pevents.conf not found, using default text events")
+        decoded = {k: decode_event(v, key[2]) for k, v in strings.items()}
+        # Cache is only an optimisation, keep going if it can't be written
+        try:
+            json_file_write(configdir_script, "overwatch-events.json", {"key": key, "events": decoded})
+        except (IOError, OSError):
+            pass
+
+    events_decoded = decoded
+    events_cache_key = key
+    return True
+
+
+# Recompile text events when the theme or prefs change
+def poll_strings(userdata=None):
+    if compile_strings():
+        print(__module_name__, "text events reloaded")
+    return 1
 
 
 def xchat_in_group():
@@ -601,17 +809,20 @@ def xchat_in_group():
 
 
 def dispatch_message(word, word_eol, event):
-    network, channel = xchat.get_info("network"), xchat.get_info("channel")
-    # Dispatch event to each group registered for this channel
-    if network in registered_channels and channel in registered_channels[network]:
-        for group in registered_channels[network][channel]:
-            # Extract nick and coloring
-            if xchat.get_prefs("text_color_nicks"):
-                (nick_color, nick) = re_nick.search(word[0]).groups("")
-            else:
-                nick_color, nick = "", word[0]
-            args = (word[1:] + padding)
-            group.on_chat_message(network, channel, event, nick, nick_color, args, word, word_eol)
+    state = channel_states.get((xchat.get_info("network"), xchat.get_info("channel")))
+    if state and state.groups:
+        # Extract nick and coloring
+        if xchat.get_prefs("text_color_nicks"):
+            (nick_color, nick) = re_nick.search(word[0]).groups("")
+        else:
+            nick_color, nick = "", word[0]
+        args = (word[1:] + padding)
+        # Recents
+        state.last_seen = now = time()
+        state.nicks[nick] = now
+        # Dispatch event to each group registered for this channel
+        for group in state.groups:
+            group.on_chat_message(state, event, nick, nick_color, args, word, word_eol, now)
     return xchat.EAT_NONE
 
 
@@ -627,6 +838,13 @@ def dispatch_command(word, word_eol, userdata):
         return group.on_command(word, word_eol)
 
 
+def dispatch_focus(word, word_eol, event):
+    focused = xchat_in_group()
+    for x in registered_groups.values():
+        x.set_focused(x is focused)
+    return xchat.EAT_NONE
+
+
 def dispatch_channels_change(word, word_eol, event):
     for x in registered_groups.values():
         x.menu_update()
@@ -681,6 +899,7 @@ menu_add("Overwatch/-")
 def load(*args):
     groups_load_from_settings()
     compile_strings()
+    xchat.hook_timer(EVENTS_POLL_INTERVAL, poll_strings)
     for event in chat_events:
         xchat.hook_print(event, dispatch_message, event)
 
@@ -689,6 +908,9 @@ def load(*args):
 
     xchat.hook_command("ov", command_handler)
 
+    for event in ["Focus Tab", "Focus Window"]:
+        xchat.hook_print(event, dispatch_focus, event)
+
     for event in ["You Join", "You Kicked", "You Part", "you Part with Reason"]:
         xchat.hook_print(event, dispatch_channels_change, event)
 